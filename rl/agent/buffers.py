@@ -1,34 +1,34 @@
-import numpy as np
 import torch
 
 
 class ReplayBuffer(object):
     """
     A simple FIFO experience replay buffer for the agent.
+    Experiences are stored on the device so sampling is a gather without host-to-device copies.
     """
 
     def __init__(self, obs_dim, act_dim, size, device):
-        self.obs1_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.obs2_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.acts_buf = np.zeros([size, act_dim], dtype=np.float32)
-        self.rews_buf = np.zeros(size, dtype=np.float32)
-        self.done_buf = np.zeros(size, dtype=np.float32)
+        self.obs1_buf = torch.zeros([size, obs_dim], dtype=torch.float32, device=device)
+        self.obs2_buf = torch.zeros([size, obs_dim], dtype=torch.float32, device=device)
+        self.acts_buf = torch.zeros([size, act_dim], dtype=torch.float32, device=device)
+        self.rews_buf = torch.zeros(size, dtype=torch.float32, device=device)
+        self.done_buf = torch.zeros(size, dtype=torch.float32, device=device)
         self.ptr, self.size, self.max_size = 0, 0, size
         self.device = device
 
     def add(self, obs, act, rew, next_obs, done):
-        self.obs1_buf[self.ptr] = obs
-        self.obs2_buf[self.ptr] = next_obs
-        self.acts_buf[self.ptr] = act
-        self.rews_buf[self.ptr] = rew
-        self.done_buf[self.ptr] = done
+        self.obs1_buf[self.ptr] = torch.as_tensor(obs, dtype=torch.float32, device=self.device)
+        self.obs2_buf[self.ptr] = torch.as_tensor(next_obs, dtype=torch.float32, device=self.device)
+        self.acts_buf[self.ptr] = torch.as_tensor(act, dtype=torch.float32, device=self.device)
+        self.rews_buf[self.ptr] = float(rew)
+        self.done_buf[self.ptr] = float(done)
         self.ptr = (self.ptr+1) % self.max_size
         self.size = min(self.size+1, self.max_size)
 
     def sample(self, batch_size=64):
-        idxs = np.random.randint(0, self.size, size=batch_size)
-        return dict(obs1=torch.Tensor(self.obs1_buf[idxs]).to(self.device),
-                    obs2=torch.Tensor(self.obs2_buf[idxs]).to(self.device),
-                    acts=torch.Tensor(self.acts_buf[idxs]).to(self.device),
-                    rews=torch.Tensor(self.rews_buf[idxs]).to(self.device),
-                    done=torch.Tensor(self.done_buf[idxs]).to(self.device))
\ No newline at end of file
+        idxs = torch.randint(0, self.size, (batch_size,), device=self.device)
+        return dict(obs1=self.obs1_buf[idxs],
+                    obs2=self.obs2_buf[idxs],
+                    acts=self.acts_buf[idxs],
+                    rews=self.rews_buf[idxs],
+                    done=self.done_buf[idxs])
\ No newline at end of file
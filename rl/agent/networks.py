@@ -1,7 +1,8 @@
+import math
+import warnings
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.distributions import Categorical, Normal
 
 
 def identity(x):
@@ -9,6 +10,15 @@ def identity(x):
     return x
 
 
+def script_module(module):
+    """Return the module compiled with TorchScript, or unchanged if it cannot be scripted."""
+    try:
+        return torch.jit.script(module)
+    except Exception as e:
+        warnings.warn('Failed to script {}, falling back to eager mode: {}'.format(type(module).__name__, e))
+        return module
+
+
 class MLP(nn.Module):
     def __init__(self, 
                  input_size, 
@@ -42,6 +52,10 @@ class MLP(nn.Module):
             self.output_layer = identity
 
     def forward(self, x):
+        return self.mlp_forward(x)
+
+    # Subclasses call this instead of super().forward(), which TorchScript does not support
+    def mlp_forward(self, x):
         for hidden_layer in self.hidden_layers:
             x = self.activation(hidden_layer(x))
         x = self.output_activation(self.output_layer(x))
@@ -54,7 +68,7 @@ SAC qf
 class FlattenMLP(MLP):
     def forward(self, x, a):
         q = torch.cat([x,a], dim=-1)
-        return super(FlattenMLP, self).forward(q)
+        return self.mlp_forward(q)
 
 
 """
@@ -84,9 +98,9 @@ class ReparamGaussianPolicy(MLP):
         # Set output layers
         self.mu_layer = nn.Linear(in_size, output_size)
         self.log_std_layer = nn.Linear(in_size, output_size)
-        self.action_scale = action_scale
+        self.action_scale = float(action_scale)
 
-    def clip_but_pass_gradient(self, x, l=-1., u=1.):
+    def clip_but_pass_gradient(self, x, l: float = -1., u: float = 1.):
         clip_up = (x > u).float()
         clip_low = (x < l).float()
         clip_value = (u - x)*clip_up + (l - x)*clip_low
@@ -100,17 +114,18 @@ class ReparamGaussianPolicy(MLP):
         return mu, pi, log_pi
 
     def forward(self, x):
-        x = super(ReparamGaussianPolicy, self).forward(x)
+        x = self.mlp_forward(x)
         
         mu = self.mu_layer(x)
         log_std = torch.tanh(self.log_std_layer(x))
         log_std = LOG_STD_MIN + 0.5 * (LOG_STD_MAX - LOG_STD_MIN) * (log_std + 1)
         std = torch.exp(log_std)
         
+        # Closed form of Normal(mu, std).rsample() and .log_prob(pi), without the Distribution overhead
         # https://pytorch.org/docs/stable/distributions.html#normal
-        dist = Normal(mu, std)
-        pi = dist.rsample() # reparameterization trick (mean + std * N(0,1))
-        log_pi = dist.log_prob(pi).sum(dim=-1)
+        eps = torch.randn_like(mu)
+        pi = mu + std * eps # reparameterization trick (mean + std * N(0,1))
+        log_pi = (-0.5 * eps.pow(2) - log_std - 0.5 * math.log(2 * math.pi)).sum(dim=-1)
         mu, pi, log_pi = self.apply_squashing_func(mu, pi, log_pi)
         
         # make sure actions are in correct range
@@ -1,14 +1,25 @@
 import os
-import numpy as np
+import warnings
 import torch
 import torch.nn as nn
 import torch.optim as optim
-import torch.nn.functional as F
 
 from agent.buffers import *
 from agent.networks import *
 
 
+@torch.jit.script
+def sac_losses(log_pi, next_log_pi, q1, q2, min_q_pi, min_q_next_pi, rews, done, 
+               alpha: float, gamma: float):
+   # Soft Bellman target and SAC losses, scripted for elementwise fusion
+   v_backup = min_q_next_pi - alpha*next_log_pi
+   q_backup = (rews + gamma*(1-done)*v_backup).detach()
+   actor_loss = (alpha*log_pi - min_q_pi).mean()
+   qf1_loss = (q1 - q_backup).pow(2).mean()
+   qf2_loss = (q2 - q_backup).pow(2).mean()
+   return actor_loss, qf1_loss, qf2_loss
+
+
 class Agent(object):
    """
    An implementation of Soft Actor-Critic (SAC) algorithm.
@@ -31,10 +42,9 @@ class Agent(object):
                 actor_lr=1e-3,
                 qf_lr=1e-3,
                 eval_mode=False,
-                actor_losses=list(),
-                qf1_losses=list(),
-                qf2_losses=list(),
-                alpha_losses=list(),
+                update_every=4,
+                gradient_steps=4,
+                use_cuda_graph=False,
                 logger=dict(),
    ):
 
@@ -53,20 +63,18 @@ class Agent(object):
       self.actor_lr = actor_lr
       self.qf_lr = qf_lr
       self.eval_mode = eval_mode
-      self.actor_losses = actor_losses
-      self.qf1_losses = qf1_losses
-      self.qf2_losses = qf2_losses
-      self.alpha_losses = alpha_losses
+      self.update_every = update_every
+      self.gradient_steps = gradient_steps
       self.logger = logger
 
       # Main network
-      self.actor = ReparamGaussianPolicy(self.obs_dim, self.act_dim, hidden_sizes=self.hidden_sizes, 
-                                                                     action_scale=self.act_limit).to(self.device)
-      self.qf1 = FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device)
-      self.qf2 = FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device)
+      self.actor = script_module(ReparamGaussianPolicy(self.obs_dim, self.act_dim, hidden_sizes=self.hidden_sizes, 
+                                                       action_scale=self.act_limit).to(self.device))
+      self.qf1 = script_module(FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device))
+      self.qf2 = script_module(FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device))
       # Target network
-      self.qf1_target = FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device)
-      self.qf2_target = FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device)
+      self.qf1_target = script_module(FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device))
+      self.qf2_target = script_module(FlattenMLP(self.obs_dim+self.act_dim, 1, hidden_sizes=self.hidden_sizes).to(self.device))
       
       # Initialize target parameters to match main parameters
       self.hard_target_update(self.qf1, self.qf1_target)
@@ -78,11 +86,25 @@ class Agent(object):
          embedding_model = torch.load(embedding_model_path, map_location=self.device)
          self.model = DynamicsEmbedding(self.obs_dim, self.obs_dim, self.act_dim).to(self.device)
          self.model.load_state_dict(embedding_model)
+         self.model.eval()
+
+      # If enabled on CUDA, the update is captured once as a CUDA graph and replayed on static input tensors
+      self.use_cuda_graph = use_cuda_graph and self.device.type == 'cuda'
+      self.graph = None
+      self.graph_warmup_steps = 3
+      self.static_batch = None
+      self.static_losses = None
+
+      # Running loss sums stay on the device so logging does not synchronize after every update
+      self.actor_loss_sum = torch.zeros((), device=self.device)
+      self.qf1_loss_sum = torch.zeros((), device=self.device)
+      self.qf2_loss_sum = torch.zeros((), device=self.device)
+      self.num_updates = 0
 
       # Create optimizers
-      self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=self.actor_lr)
-      self.qf1_optimizer = optim.Adam(self.qf1.parameters(), lr=self.qf_lr)
-      self.qf2_optimizer = optim.Adam(self.qf2.parameters(), lr=self.qf_lr)
+      self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=self.actor_lr, capturable=self.use_cuda_graph)
+      self.qf1_optimizer = optim.Adam(self.qf1.parameters(), lr=self.qf_lr, capturable=self.use_cuda_graph)
+      self.qf2_optimizer = optim.Adam(self.qf2.parameters(), lr=self.qf_lr, capturable=self.use_cuda_graph)
       
       # Experience buffer
       self.replay_buffer = ReplayBuffer(self.obs_dim, self.act_dim, self.buffer_size, self.device)
@@ -91,11 +113,62 @@ class Agent(object):
       target.load_state_dict(main.state_dict())
 
    def soft_target_update(self, main, target, tau=0.005):
-      for main_param, target_param in zip(main.parameters(), target.parameters()):
-         target_param.data.copy_(tau*main_param.data + (1.0-tau)*target_param.data)
+      # Update all parameters with two multi-tensor kernels instead of one kernel per parameter
+      main_params = list(main.parameters())
+      target_params = list(target.parameters())
+      with torch.no_grad():
+         torch._foreach_mul_(target_params, 1.0-tau)
+         torch._foreach_add_(target_params, main_params, alpha=tau)
+
+   def maybe_train(self):
+      # Start training when the number of experience is greater than batch size
+      if self.steps > self.batch_size and self.steps % self.update_every == 0:
+         for _ in range(self.gradient_steps):
+            self.train_model()
 
    def train_model(self):
       batch = self.replay_buffer.sample(self.batch_size)
+
+      if not self.use_cuda_graph:
+         actor_loss, qf1_loss, qf2_loss = self.update_model(batch)
+      else:
+         if self.static_batch is None:
+            self.static_batch = {key: value.clone() for key, value in batch.items()}
+         for key, value in batch.items():
+            self.static_batch[key].copy_(value)
+
+         if self.graph is not None:
+            self.graph.replay()
+         elif self.graph_warmup_steps > 0:
+            # Warm up on a side stream before capture, as torch.cuda.graph requires
+            stream = torch.cuda.Stream(self.device)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+               self.static_losses = self.update_model(self.static_batch)
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            self.graph_warmup_steps -= 1
+         else:
+            try:
+               # Capture only records the kernels, so replay once to apply this update
+               graph = torch.cuda.CUDAGraph()
+               with torch.cuda.graph(graph):
+                  self.static_losses = self.update_model(self.static_batch)
+               graph.replay()
+               self.graph = graph
+            except Exception as e:
+               warnings.warn('Failed to capture the SAC update as a CUDA graph, '
+                             'falling back to eager mode: {}'.format(e))
+               self.use_cuda_graph = False
+               self.static_losses = self.update_model(self.static_batch)
+         actor_loss, qf1_loss, qf2_loss = self.static_losses
+      
+      # Save losses
+      self.actor_loss_sum += actor_loss
+      self.qf1_loss_sum += qf1_loss
+      self.qf2_loss_sum += qf2_loss
+      self.num_updates += 1
+
+   def update_model(self, batch):
       obs1 = batch['obs1']
       obs2 = batch['obs2']
       acts = batch['acts']
@@ -109,21 +182,20 @@ class Agent(object):
          print("rews", rews.shape)
          print("done", done.shape)
 
-      # Prediction π(s), logπ(s), π(s'), logπ(s'), Q1(s,a), Q2(s,a)
-      _, pi, log_pi = self.actor(obs1)
-      _, next_pi, next_log_pi = self.actor(obs2)
+      # Prediction π(s), logπ(s), π(s'), logπ(s') with a single actor forward over [s; s']
+      _, pi_all, log_pi_all = self.actor(torch.cat([obs1, obs2], dim=0))
+      pi, next_pi = pi_all.chunk(2, dim=0)
+      log_pi, next_log_pi = log_pi_all.chunk(2, dim=0)
+
+      # Prediction Q1(s,a), Q2(s,a)
       q1 = self.qf1(obs1, acts).squeeze(1)
       q2 = self.qf2(obs1, acts).squeeze(1)
 
       # Min Double-Q: min(Q1(s,π(s)), Q2(s,π(s))), min(Q1‾(s',π(s')), Q2‾(s',π(s')))
-      min_q_pi = torch.min(self.qf1(obs1, pi), self.qf2(obs1, pi)).squeeze(1).to(self.device)
-      min_q_next_pi = torch.min(self.qf1_target(obs2, next_pi), 
-                                self.qf2_target(obs2, next_pi)).squeeze(1).to(self.device)
-
-      # Targets for Q and V regression
-      v_backup = min_q_next_pi - self.alpha*next_log_pi
-      q_backup = rews + self.gamma*(1-done)*v_backup
-      q_backup.to(self.device)
+      min_q_pi = torch.min(self.qf1(obs1, pi), self.qf2(obs1, pi)).squeeze(1)
+      with torch.no_grad():
+         min_q_next_pi = torch.min(self.qf1_target(obs2, next_pi), 
+                                   self.qf2_target(obs2, next_pi)).squeeze(1)
 
       if 0: # Check shape of prediction and target
          print("log_pi", log_pi.shape)
@@ -132,35 +204,79 @@ class Agent(object):
          print("q2", q2.shape)
          print("min_q_pi", min_q_pi.shape)
          print("min_q_next_pi", min_q_next_pi.shape)
-         print("q_backup", q_backup.shape)
 
-      # Soft actor-critic losses
-      actor_loss = (self.alpha*log_pi - min_q_pi).mean()
-      qf1_loss = F.mse_loss(q1, q_backup.detach())
-      qf2_loss = F.mse_loss(q2, q_backup.detach())
+      # Soft actor-critic losses with targets for Q and V regression
+      actor_loss, qf1_loss, qf2_loss = sac_losses(log_pi, next_log_pi, q1, q2, min_q_pi, min_q_next_pi, 
+                                                  rews, done, self.alpha, self.gamma)
 
-      # Update two Q network parameter
-      self.qf1_optimizer.zero_grad()
-      qf1_loss.backward()
-      self.qf1_optimizer.step()
-
-      self.qf2_optimizer.zero_grad()
-      qf2_loss.backward()
-      self.qf2_optimizer.step()
-      
       # Update actor network parameter
-      self.actor_optimizer.zero_grad()
+      # This runs before the Q update, whose in-place optimizer steps would invalidate the actor's graph.
+      self.actor_optimizer.zero_grad(set_to_none=True)
       actor_loss.backward()
       self.actor_optimizer.step()
 
+      # Update two Q network parameter with a single backward pass
+      self.qf1_optimizer.zero_grad(set_to_none=True)
+      self.qf2_optimizer.zero_grad(set_to_none=True)
+      (qf1_loss + qf2_loss).backward()
+      self.qf1_optimizer.step()
+      self.qf2_optimizer.step()
+
       # Polyak averaging for target parameter
       self.soft_target_update(self.qf1, self.qf1_target)
       self.soft_target_update(self.qf2, self.qf2_target)
+      return actor_loss.detach(), qf1_loss.detach(), qf2_loss.detach()
+
+   def eval_step_raw(self, obs):
+      obs_t = torch.as_tensor(obs, dtype=torch.float32, device=self.device)
+      with torch.no_grad():
+         action, _, _ = self.actor(obs_t)
+      action = action.cpu().numpy()
+      next_obs, reward, done, _ = self.env.step(action)
+      return next_obs, reward, done
+
+   def eval_step_embed(self, obs):
+      obs_t = torch.as_tensor(obs, dtype=torch.float32, device=self.device)
+      with torch.no_grad():
+         z_obs = self.model.encode(obs_t)[0]
+         action, _, _ = self.actor(z_obs)
+      action = action.cpu().numpy()
+      next_obs, reward, done, _ = self.env.step(action)
+      return next_obs, reward, done
+
+   def train_step_raw(self, obs):
+      # Collect experience (s, a, r, s') using some policy
+      obs_t = torch.as_tensor(obs, dtype=torch.float32, device=self.device)
+      with torch.no_grad():
+         _, action, _ = self.actor(obs_t)
+      action = action.cpu().numpy()
       
-      # Save losses
-      self.actor_losses.append(actor_loss.item())
-      self.qf1_losses.append(qf1_loss.item())
-      self.qf2_losses.append(qf2_loss.item())
+      next_obs, reward, done, _ = self.env.step(action)
+
+      # Add experience to replay buffer
+      self.replay_buffer.add(obs, action, reward, next_obs, done)
+      
+      self.maybe_train()
+      return next_obs, reward, done
+
+   def train_step_embed(self, obs):
+      # Collect experience (z_s, a, r, z_s') using some policy
+      with torch.no_grad():
+         _, action, _ = self.actor(self.z_obs)
+      action = action.cpu().numpy()
+
+      next_obs, reward, done, _ = self.env.step(action)
+
+      with torch.no_grad():
+         next_obs_t = torch.as_tensor(next_obs, dtype=torch.float32, device=self.device)
+         z_next_obs = self.model.encode(next_obs_t)[0]
+
+      # Add experience to replay buffer
+      self.replay_buffer.add(self.z_obs, action, reward, z_next_obs, done)
+      self.z_obs = z_next_obs
+      
+      self.maybe_train()
+      return next_obs, reward, done
 
    def run(self, max_step):
       step_number = 0
@@ -169,60 +285,28 @@ class Agent(object):
       obs = self.env.reset()
       done = False
 
+      # Select the step function once, since mode and eval_mode are fixed for the whole episode
+      if self.eval_mode:
+         step_fn = self.eval_step_embed if self.args.mode == 'embed' else self.eval_step_raw
+      else:
+         step_fn = self.train_step_embed if self.args.mode == 'embed' else self.train_step_raw
+
+      # Encode the first observation only; later latents are carried over from the previous step
+      if self.args.mode == 'embed' and not self.eval_mode:
+         with torch.no_grad():
+            self.z_obs = self.model.encode(torch.as_tensor(obs, dtype=torch.float32, device=self.device))[0]
+
       # Keep interacting until agent reaches a terminal state.
       while not (done or step_number == max_step):
          self.steps += 1
-         
-         if self.eval_mode:
-            if self.args.mode == 'raw':
-               action, _, _ = self.actor(torch.Tensor(obs).to(self.device))
-               action = action.detach().cpu().numpy()
-            elif self.args.mode == 'embed':
-               z_obs = self.model.encode(torch.Tensor(obs).to(self.device))[0]
-               z_obs = z_obs.detach().cpu().numpy()
-               action, _, _ = self.actor(torch.Tensor(z_obs).to(self.device))
-               action = action.detach().cpu().numpy()
-            next_obs, reward, done, _ = self.env.step(action)
-         else:
-            if self.args.mode == 'raw':
-               # Collect experience (s, a, r, s') using some policy
-               _, action, _ = self.actor(torch.Tensor(obs).to(self.device))
-               action = action.detach().cpu().numpy()
-               
-               next_obs, reward, done, _ = self.env.step(action)
-
-               # Add experience to replay buffer
-               self.replay_buffer.add(obs, action, reward, next_obs, done)
-               
-               # Start training when the number of experience is greater than batch size
-               if self.steps > self.batch_size:
-                  self.train_model()
-            elif self.args.mode == 'embed':
-               # Collect experience (z_s, a, r, z_s') using some policy
-               z_obs = self.model.encode(torch.Tensor(obs).to(self.device))[0]
-               z_obs = z_obs.detach().cpu().numpy()
-
-               _, action, _ = self.actor(torch.Tensor(z_obs).to(self.device))
-               action = action.detach().cpu().numpy()
-
-               next_obs, reward, done, _ = self.env.step(action)
-
-               z_next_obs = self.model.encode(torch.Tensor(next_obs).to(self.device))[0]
-               z_next_obs = z_next_obs.detach().cpu().numpy()
-
-               # Add experience to replay buffer
-               self.replay_buffer.add(z_obs, action, reward, z_next_obs, done)
-               
-               # Start training when the number of experience is greater than batch size
-               if self.steps > self.batch_size:
-                  self.train_model()
+         next_obs, reward, done = step_fn(obs)
 
          total_reward += reward
          step_number += 1
          obs = next_obs
       
       # Save logs
-      self.logger['LossPi'] = round(np.mean(self.actor_losses), 4)
-      self.logger['LossQ1'] = round(np.mean(self.qf1_losses), 4)
-      self.logger['LossQ2'] = round(np.mean(self.qf2_losses), 4)
-      return step_number, total_reward
+      self.logger['LossPi'] = round((self.actor_loss_sum / self.num_updates).item(), 4)
+      self.logger['LossQ1'] = round((self.qf1_loss_sum / self.num_updates).item(), 4)
+      self.logger['LossQ2'] = round((self.qf2_loss_sum / self.num_updates).item(), 4)
+      return step_number, total_reward
\ No newline at end of file